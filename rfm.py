@@ -1,6 +1,14 @@
+import warnings
+
+import numpy as np
 import pandas as pd
 from pprint import pprint
 
+try:  # polars не обязателен: без него метрики считаются средствами pandas
+    import polars as pl
+except ImportError:
+    pl = None
+
 
 def get_rfm_values(
     df,
@@ -8,15 +16,17 @@ def get_rfm_values(
     money,
     time,
     now,
-    time_horizon
+    time_horizon,
+    n_chunks=1
 ):
     '''
     Функция считает метрики recency, frequency и monetary для каждого unit_id в df
     
     Parameters
     ----------
-    df: pandas.DataFrame
+    df: pandas.DataFrame || polars.DataFrame
         Исходный df без пропущенных значений
+        (при установленном polars агрегация выполняется средствами polars)
     unit_id: str
         Название столбца с id для каждого из которых необходимо считать значения recency, frequency и monetary
         Например, customer_id
@@ -28,34 +38,143 @@ def get_rfm_values(
         Текущие дата и время
     time_horizon: int
         Временной горизонт, на котором считаются метрики (количество рассматриваемых дней от текущего)
+    n_chunks: int, default 1
+        Количество частей, на которые разбивается df при расчёте средствами pandas
+        (частичные агрегаты по частям объединяются; уменьшает пиковое потребление памяти)
+        При n_chunks > 1 pandas.DataFrame обрабатывается средствами pandas, даже если установлен polars
+        (преобразование в polars копирует весь df); для polars.DataFrame параметр не используется
+    
+    Returns
+    -------
+    rfm_df: pandas.DataFrame || polars.DataFrame
+        df с добавленными столбцами (recency, frequency и monetary), того же типа, что и исходный df
+    '''
+    if n_chunks < 1:
+        raise ValueError(f'n_chunks должен быть >= 1, получено {n_chunks}')
+    start_time = now - pd.Timedelta(days=time_horizon)  # Начало временного горизонта
+    if pl is not None and (isinstance(df, pl.DataFrame) or n_chunks == 1):
+        if n_chunks > 1:
+            warnings.warn('n_chunks не используется для polars.DataFrame', stacklevel=2)
+        return _get_rfm_values_polars(df, unit_id, money, time, now, start_time)
+    # Частичные агрегаты по частям df
+    bounds = np.linspace(0, len(df), n_chunks + 1).astype(int)
+    partials = [
+        _get_partial_rfm_values(df.iloc[start:stop], unit_id, money, time, now, start_time)
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+    rfm_df = partials[0] if len(partials) == 1 else _merge_partial_rfm_values(partials, unit_id)
+    
+    return _finalize_rfm_values(rfm_df, unit_id, now)
+
+
+def get_rfm_values_from_csv(
+    path,
+    unit_id,
+    money,
+    time,
+    now,
+    time_horizon,
+    chunksize=1_000_000
+):
+    '''
+    Функция считает метрики recency, frequency и monetary для каждого unit_id по csv файлу,
+    читая его частями (весь файл не загружается в память)
+    
+    Parameters
+    ----------
+    path: str
+        Путь к csv файлу, каждая строка которого - покупка unit_id
+    unit_id, money, time, now, time_horizon:
+        См. get_rfm_values
+    chunksize: int, default 1_000_000
+        Количество строк файла, считываемых за один раз
     
     Returns
     -------
     rfm_df: pandas.DataFrame
-        df с добавленными столбцами (recency, frequency и monetary)
+        df со столбцами unit_id, recency, frequency и monetary
+        (unit_id читаются как строки, без приведения типа)
     '''
+    start_time = now - pd.Timedelta(days=time_horizon)  # Начало временного горизонта
+    reader = pd.read_csv(
+        path,
+        usecols=[unit_id, money, time],
+        # Тип unit_id фиксирован: при выводе типа по каждой части отдельно один и тот же
+        # unit_id мог бы прочитаться в разных частях как число и как строка ('00123' и 123)
+        dtype={unit_id: str},
+        parse_dates=[time],
+        chunksize=chunksize
+    )
+    # Частичные агрегаты по прочитанным частям объединяются попарно по уровням (как в двоичном
+    # счётчике): каждый агрегат объединяется O(log(количество частей)) раз, а в памяти находятся
+    # одна часть файла и не более log2(количество частей) агрегатов по unit_id
+    levels = []  # Стек пар (уровень, агрегат)
+    with reader:
+        for chunk in reader:
+            partial = _get_partial_rfm_values(chunk, unit_id, money, time, now, start_time)
+            level = 0
+            while levels and levels[-1][0] == level:
+                partial = _merge_partial_rfm_values([levels.pop()[1], partial], unit_id)
+                level += 1
+            levels.append((level, partial))
+    partials = [partial for _, partial in levels]
+    rfm_df = partials[0] if len(partials) == 1 else _merge_partial_rfm_values(partials, unit_id)
+    
+    return _finalize_rfm_values(rfm_df, unit_id, now)
+
+
+def _get_partial_rfm_values(df, unit_id, money, time, now, start_time):
+    '''Частичные агрегаты (дата последней покупки, frequency и monetary) для каждого unit_id в df'''
     # Фильтрация данных по временному горизонту
-    start_time = now - pd.Timedelta(days=time_horizon)
-    df = df.query('@start_time <= ' + time + ' and ' + time + ' <= @now')
-    # Добавление колонки с количеством дней до текущего момента
-    df['days_before'] = (now - df[time]).dt.days
+    # (сравнение средствами pandas, чтобы учитывались часовые пояса)
+    df = df.loc[df[time].between(start_time, now)]
     # Расчёт метрик
-    agg_exp = {  # Агрегирующие выражения
-        'days_before': 'min',     # Количество дней с последней покупки пользователем (recency)
-        time: 'count',            # Количество заказов пользователя (frequency)
-        money: 'sum'              # Доход от пользователя (monetary)
-    }
-    new_columns = {  # Новые названия столбцов
-        'days_before':       'recency',
-        'order_approved_at': 'frequency',
-        money:               'monetary'
-    }
-    rfm_df = (
-        df.groupby(unit_id, as_index=False).agg(agg_exp)
-        .rename(columns=new_columns)
+    return df.groupby(unit_id, as_index=False).agg(
+        last_purchase=(time, 'max'),   # Дата последней покупки пользователя
+        frequency=(time, 'count'),     # Количество заказов пользователя (frequency)
+        monetary=(money, 'sum')        # Доход от пользователя (monetary)
     )
+
+
+def _merge_partial_rfm_values(partials, unit_id):
+    '''Объединение частичных агрегатов (см. _get_partial_rfm_values) по unit_id'''
+    return pd.concat(partials, ignore_index=True).groupby(unit_id, as_index=False).agg(
+        {'last_purchase': 'max', 'frequency': 'sum', 'monetary': 'sum'}
+    )
+
+
+def _finalize_rfm_values(rfm_df, unit_id, now):
+    '''Итоговый df с метриками recency, frequency и monetary из агрегатов по unit_id'''
+    # Количество дней с последней покупки пользователем (recency)
+    # (считается по сгруппированному df как разность в наносекундах на int64,
+    # без дополнительного столбца на весь исходный df и без аксессора .dt;
+    # для дат с часовым поясом используются наносекунды UTC)
+    last_purchase = pd.DatetimeIndex(rfm_df['last_purchase']).as_unit('ns').asi8
+    delta_ns = pd.Timestamp(now).as_unit('ns').value - last_purchase
+    rfm_df['recency'] = delta_ns // 86_400_000_000_000  # Наносекунд в сутках
     
-    return rfm_df
+    return rfm_df[[unit_id, 'recency', 'frequency', 'monetary']]
+
+
+def _get_rfm_values_polars(df, unit_id, money, time, now, start_time):
+    '''Расчёт метрик recency, frequency и monetary средствами polars (за один проход groupby)'''
+    is_pandas = isinstance(df, pd.DataFrame)
+    if is_pandas:
+        df = pl.from_pandas(df[[unit_id, time, money]])  # В polars копируются только нужные столбцы
+    rfm_df = (
+        df.lazy()
+        .filter(pl.col(time).is_between(start_time, now))
+        .group_by(unit_id)
+        .agg([
+            (pl.lit(now) - pl.col(time)).dt.total_days().min().alias('recency'),  # Количество дней с последней покупки
+            pl.col(time).count().cast(pl.Int64).alias('frequency'),               # Количество заказов
+            pl.col(money).sum().alias('monetary')                                 # Доход от пользователя
+        ])
+        .sort(unit_id)
+        .collect()
+    )
+
+    return rfm_df.to_pandas() if is_pandas else rfm_df
 
 
 def get_rfm_score(
@@ -89,7 +208,8 @@ def get_rfm_score(
         Автоматическая корректировка max_score (уменьшение) при совпадении значений квантилей
     add_score_bins: bool, default False
         Добавить к возвращаемому df столбец с информацией по диапазону значений из score_column, 
-        соответствующих оценке
+        соответствующих оценке (как и столбец с оценками, имеет тип category; если после 
+        округления диапазоны совпадают - строки типа object)
         Пояснение по интервалам: 
             [a_1, b_1] => score_1
             (b_1, b_2] => score_2
@@ -112,6 +232,96 @@ def get_rfm_score(
     score_df: pd.DataFrame
         df со столбцом, где записаны оценки для параметра
     '''
+    score_columns = _get_rfm_score_columns(
+        df=df,
+        score_column=score_column,
+        score_name=score_name,
+        max_score=max_score,
+        add_score_bins=add_score_bins,
+        auto_max_score_adjust=auto_max_score_adjust,
+        print_info=print_info,
+        round_info_val=round_info_val
+    )
+    
+    return df.assign(**score_columns)
+
+
+def get_rfm_scores(
+    df,
+    r_column='recency',
+    f_column='frequency',
+    m_column='monetary',
+    max_score=3,
+    add_score_bins=False,
+    auto_max_score_adjust=False,
+    print_info=True,
+    round_info_val=3
+):
+    '''
+    Функция для оценивания сразу всех параметров recency, frequency и monetary (оценки r, f, m)
+    Квантили для трёх столбцов считаются одним вызовом np.quantile, далее оценивание 
+    выполняется так же, как в get_rfm_score
+
+    Arguments
+    ---------
+    df: pd.DataFrame
+        Исходный df с рассчитанными метриками recency, frequency и monetary для каждого unit_id
+    r_column: str, default 'recency'
+        Название столбца с recency
+    f_column: str, default 'frequency'
+        Название столбца с frequency
+    m_column: str, default 'monetary'
+        Название столбца с monetary
+    max_score, add_score_bins, auto_max_score_adjust, print_info, round_info_val:
+        См. get_rfm_score (применяются к каждому из параметров)
+
+    Returns
+    -------
+    score_df: pd.DataFrame
+        df со столбцами r, f, m, где записаны оценки для параметров
+    '''
+    score_columns = {'r': r_column, 'f': f_column, 'm': m_column}
+    if max_score > 1:
+        # Значения квантилей для всех столбцов: массив (max_score-1, 3)
+        d_quantile = 1 / max_score  # Межквантильный интервал
+        quintile_list = [d_quantile*i for i in range(1, max_score)]  # Список квантилей
+        values = df[list(score_columns.values())].to_numpy(dtype=float)
+        # (пропуски не учитываются, как и в get_rfm_score)
+        quantile_func = np.nanquantile if np.isnan(values).any() else np.quantile
+        edges = quantile_func(values, quintile_list, axis=0)
+    
+    new_columns = {}  # Столбцы с оценками всех параметров (добавляются к df одной операцией)
+    for i, (score_name, score_column) in enumerate(score_columns.items()):
+        new_columns.update(_get_rfm_score_columns(
+            df=df,
+            score_column=score_column,
+            score_name=score_name,
+            max_score=max_score,
+            add_score_bins=add_score_bins,
+            auto_max_score_adjust=auto_max_score_adjust,
+            print_info=print_info,
+            round_info_val=round_info_val,
+            quantiles=edges[:, i].tolist() if max_score > 1 else None
+        ))
+    
+    return df.assign(**new_columns)
+
+
+def _get_rfm_score_columns(
+    df,
+    score_column,
+    score_name,
+    max_score,
+    add_score_bins,
+    auto_max_score_adjust,
+    print_info,
+    round_info_val,
+    quantiles=None
+):
+    '''
+    Столбцы с оценками параметра (см. get_rfm_score), исходный df не изменяется
+    quantiles - заранее посчитанные значения квантилей для max_score
+    '''
     # Полное название используемой метрики
     if score_name == 'r':
         metric = 'recency'
@@ -124,82 +334,92 @@ def get_rfm_score(
     
     # Столбец со значениями для оценивания
     vals = df[score_column]
+    arr = vals.to_numpy()
+    nan_mask = vals.isna().to_numpy()  # Пропуски не оцениваются (оценка NaN, как у pd.cut)
+    valid = arr[~nan_mask] if nan_mask.any() else arr  # Значения для квантилей и отсечек
     
-    if max_score > 1:
-        # Квантили и соответствующие им значения
+    # Квантили и соответствующие им значения
+    # (при auto_max_score_adjust max_score уменьшается, пока квантили не перестанут совпадать)
+    while max_score > 1:
         d_quantile = 1 / max_score  # Межквантильный интервал
         quintile_list = [d_quantile*i for i in range(1, max_score)]  # Список квантилей
-        quantiles = vals.quantile(quintile_list).tolist()  # Список значений квантилей
+        if quantiles is None:
+            quantiles = np.quantile(valid, quintile_list).tolist()  # Список значений квантилей
+        
+        if len(quantiles) == len(set(quantiles)):
+            break
         
         # Случай дублирования квантилей
-        if len(quantiles) != len(set(quantiles)):
-            if auto_max_score_adjust:
-                print(f'AUTO ADJUSTMENT max_score={max_score} ->', max_score-1)
-                return get_rfm_score(
-                    df=df,
-                    score_column=score_column,
-                    score_name=score_name,
-                    max_score=max_score-1,
-                    add_score_bins=add_score_bins,
-                    auto_max_score_adjust=auto_max_score_adjust,
-                    print_info=print_info,
-                    round_info_val=round_info_val
-                )
-            else:
-                quintile_dict = ( # Словарь с квантилями (для вывода информации)
-                    vals
-                    .quantile(quintile_list)
-                    .to_frame().reset_index().round(round_info_val)
-                    .rename(columns={vals.name: metric + '_quantiles'})
-                    .set_index('index')
-                    .to_dict()
-                )
-                raise QuantileDuplicate(quintile_dict)  # Отображение исключения
-
+        if not auto_max_score_adjust:
+            quintile_dict = {  # Словарь с квантилями (для вывода информации)
+                metric + '_quantiles': {
+                    round(q, round_info_val): round(v, round_info_val)
+                    for q, v in zip(quintile_list, quantiles)
+                }
+            }
+            raise QuantileDuplicate(quintile_dict)  # Отображение исключения
+        print(f'AUTO ADJUSTMENT max_score={max_score} ->', max_score-1)
+        max_score -= 1
+        quantiles = None
+    
+    if max_score > 1:
         scores_list = [i for i in range(1, max_score+1)]  # Список оценок
-        bins_cutoffs = [vals.min()] + quantiles + [vals.max()]  # Список отсечек для разбиения
+        bins_cutoffs = [valid.min()] + quantiles + [valid.max()]  # Список отсечек для разбиения
                                                                 # данных на промежутки и
                                                                 # получения оценок
         # Присвоение оценок исходным значениям
         if score_name == 'r':
             scores_list.reverse()  # Оценки в обратном порядке (чем меньше абсолютнное значение recency, тем лучше, с оценкой - наоборот)
-            scores = pd.cut(
-                x=vals, 
-                bins=[bins_cutoffs[0]-1] + bins_cutoffs[1:-1] + [bins_cutoffs[-1]+1], 
-                labels=scores_list, 
-                include_lowest=True).astype(str)
-        else:
-            scores = pd.cut(
-                x=vals, 
-                bins=[bins_cutoffs[0]-1] + bins_cutoffs[1:-1] + [bins_cutoffs[-1]+1], 
-                labels=scores_list, 
-                include_lowest=True).astype(str)
+        # Номер интервала (a, b] для каждого значения: 0..max_score-1
+        # (значения за пределами отсечек попадают в крайние интервалы)
+        codes = np.searchsorted(quantiles, arr, side='left')
+        if score_name == 'r':
+            codes = max_score - 1 - codes
+        codes[nan_mask] = -1  # Код -1 в pd.Categorical соответствует NaN
+        # Оценки хранятся как категории '1'..max_score (код категории = оценка - 1)
+        scores = pd.Series(
+            pd.Categorical.from_codes(codes, categories=[str(i) for i in range(1, max_score+1)]),
+            index=vals.index
+        )
     else:  # max_score == 1
         scores_list = ['1']
-        bins_cutoffs =  [vals.min(), vals.max()]
-        scores = pd.Series(['1' for _ in range(len(vals))])
-    
-    # Добавление столбца с оценками
-    df[score_name] = scores
+        bins_cutoffs =  [valid.min(), valid.max()]
+        scores = pd.Series(
+            pd.Categorical.from_codes(-nan_mask.astype(np.int8), categories=['1']),
+            index=vals.index
+        )
     
+    # Столбец с оценками
+    score_columns = {score_name: scores}
     
     # Информация по диапазону значений из score_column, соответствующих оценке
-    bins_for_scores = {}
-    for i, score in enumerate(scores_list):
-            bins_for_scores[str(score)] = str([round(bins_cutoffs[i], round_info_val), 
-                                               round(bins_cutoffs[i+1], round_info_val)])
+    # (строится только если она будет выведена или добавлена в df)
+    if print_info or add_score_bins:
+        rounded = np.round(np.asarray(bins_cutoffs, dtype=float), round_info_val)  # Округлённые отсечки
+        bins_for_scores = {
+            str(score): f'[{rounded[i]}, {rounded[i+1]}]' for i, score in enumerate(scores_list)
+        }
 
-    # Добавление к возвращаемому df столбца с информацией по диапазону значений из score_column, 
-    # соответствующих оценке
+    # Столбец с информацией по диапазону значений из score_column, соответствующих оценке
     if add_score_bins:
-        df[score_name + '_bin'] = scores.replace(bins_for_scores)
+        # Диапазоны в порядке кодов категорий оценок
+        bin_labels = [bins_for_scores[c] for c in scores.cat.categories]
+        if len(set(bin_labels)) == len(bin_labels):
+            # Переименование категорий оценок (без поэлементной обработки)
+            score_columns[score_name + '_bin'] = scores.cat.rename_categories(bin_labels)
+        else:  # После округления диапазоны совпали и не могут быть категориями
+            # (код -1 у пропусков выбирает последний элемент - NaN)
+            score_columns[score_name + '_bin'] = pd.Series(
+                np.asarray(bin_labels + [np.nan], dtype=object)[scores.cat.codes.to_numpy()],
+                index=scores.index
+            )
     
     # Вывод информации
     if print_info:
         # Информация по диапазону параметров для оценок
         pprint({'bins_for_scores': bins_for_scores})
     
-    return df
+    return score_columns
 
 
 class QuantileDuplicate(Exception):
@@ -226,7 +446,7 @@ def get_rfm_agg(
     df: pandas.DataFrame
         Исходный df с оцененными метриками r, f, m
     unit_id: str
-        Название столбца для подсчёта количества градаций его значений
+        Название столбца с id, количество заполненных значений которого считается в каждом сегменте
     r_name: str, default 'r'
         Название столбца с оценкой recency: r
     f_name: str, default 'f'
@@ -235,6 +455,7 @@ def get_rfm_agg(
         Название столбца с оценкой monetary: m
     use_bins: bool, default False,
         Флаг отображения в итоговой таблице диапазона значений метрик для оценок
+        (столбцы с диапазонами в итоговой таблице - строки типа object)
     r_bins_name: str, default 'r_bins'
         Название столбца с диапазоном метрик оценки recency
     f_bins_name: str, default 'f_bins'
@@ -246,21 +467,79 @@ def get_rfm_agg(
     -------
     rfm_df: pandas.DataFrame
         Итоговый df с rfm сегментами и количеством unit_id в каждом из них
+        (сегменты отсортированы по названию rfm по убыванию, как строки)
     '''
-    df['rfm'] = df[r_name] + df[f_name] + df[m_name]
+    # Упаковка оценок r, f, m в один целочисленный код
+    (r_codes, r_scores, r_labels), (f_codes, f_scores, f_labels), (m_codes, m_scores, m_labels) = (
+        _get_score_codes(df[name]) for name in (r_name, f_name, m_name)
+    )
+    base = int(max(r_scores.max(initial=0), f_scores.max(initial=0), m_scores.max(initial=0))) + 1  # Основание кода
+    codes = _pack_rfm_codes(r_codes, f_codes, m_codes, r_scores, f_scores, m_scores, base)
+    # Строки с пропущенной оценкой (код -1) не попадают ни в один сегмент (как при groupby)
+    scored_rows = np.flatnonzero(codes >= 0)
+    codes = codes[scored_rows]
     
-    if use_bins:
-        rfm_df = (
-            df.
-            groupby(['rfm', r_bin_name, f_bin_name, m_bin_name], as_index=False)[unit_id].count()
-            .rename(columns={unit_id: 'amount'})
-        )
+    # Количество строк и количество заполненных unit_id в каждом сегменте (гистограммы по кодам сегментов)
+    counts = np.bincount(codes, minlength=base**3)
+    unit_mask = df[unit_id].notna().to_numpy()[scored_rows]
+    unit_counts = counts if unit_mask.all() else np.bincount(codes[unit_mask], minlength=base**3)
+    # Коды непустых сегментов по убыванию (для оценок 1..9 совпадает с сортировкой
+    # названий сегментов по убыванию, но без сравнения строк)
+    present = np.flatnonzero(counts)[::-1]
+    if base <= 10 and r_labels is None and f_labels is None and m_labels is None:
+        labels = [f'{c // base**2}{c // base % base}{c % base}' for c in present]
     else:
-        rfm_df = (
-            df.
-            groupby('rfm', as_index=False)[unit_id].count()
-            .rename(columns={unit_id: 'amount'})
+        # Оценки больше 9 или нецелочисленные оценки: порядок кодов не совпадает с порядком строк,
+        # поэтому названия сегментов (из названий категорий) сортируются по убыванию как строки
+        r_labels, f_labels, m_labels = (
+            [str(score) for score in range(base)] if score_labels is None else score_labels
+            for score_labels in (r_labels, f_labels, m_labels)
         )
-        
+        labels = np.asarray(
+            [r_labels[c // base**2] + f_labels[c // base % base] + m_labels[c % base] for c in present],
+            dtype=object
+        )
+        order = np.argsort(labels, kind='stable')[::-1]
+        present, labels = present[order], labels[order].tolist()
+    rfm_df = pd.DataFrame({'rfm': labels})
     
-    return rfm_df.sort_values('rfm', ascending=False).reset_index(drop=True)
\ No newline at end of file
+    if use_bins:
+        # Диапазоны метрик однозначно определяются оценками, поэтому для каждого сегмента
+        # достаточно взять их из любой строки с тем же кодом
+        rows = np.empty(base**3, dtype=np.intp)
+        rows[codes] = scored_rows
+        for bin_name in (r_bin_name, f_bin_name, m_bin_name):
+            rfm_df[bin_name] = df[bin_name].iloc[rows[present]].astype(object).reset_index(drop=True)
+    
+    rfm_df['amount'] = unit_counts[present]
+    
+    return rfm_df
+
+
+def _get_score_codes(scores):
+    '''
+    Коды категорий оценок (-1 для пропусков), таблица целочисленных значений оценок для каждой категории
+    и названия оценок по их значениям (None, если оценки - целые числа, записанные как str(значение))
+    '''
+    if not isinstance(scores.dtype, pd.CategoricalDtype):
+        scores = scores.astype('category')
+    codes = scores.cat.codes.to_numpy()
+    labels = [str(category) for category in scores.cat.categories]
+    try:
+        values = np.asarray(labels, dtype=np.int64)
+    except ValueError:
+        values = None
+    if values is None or (values < 0).any() or [str(value) for value in values] != labels:
+        # Нецелочисленные оценки (например, 'A' или '3.0'): значением оценки считается номер категории
+        return codes, np.arange(len(labels), dtype=np.int64), labels
+    return codes, values, None
+
+
+def _pack_rfm_codes(r_codes, f_codes, m_codes, r_scores, f_scores, m_scores, base):
+    '''
+    Код rfm сегмента для каждой строки: выбор оценок по кодам категорий и упаковка
+    (-1, если хотя бы одна из оценок пропущена)
+    '''
+    out = (r_scores[r_codes]*base + f_scores[f_codes])*base + m_scores[m_codes]
+    out[(r_codes < 0) | (f_codes < 0) | (m_codes < 0)] = -1
+    return out